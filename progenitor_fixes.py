@@ -3,6 +3,50 @@ import re
 import itertools
 import sys
 import os
+from pathlib import Path
+
+# Patterns used by --lib-fix, compiled once. The generated sources are
+# processed as UTF-8 bytes; every pattern and marker is ASCII
+ERROR_ENUM_RE = re.compile(rb'#\[derive\(([^)]+)\)\](\n(?:\s*#\[[^\n]+\n)*)(\s*)pub enum (RpcRequestValidationErrorKind|[A-Z][a-zA-Z0-9]*Error)\b')
+DISPLAY_IMPL_RE = re.compile(rb'impl ::std::fmt::Display for (\w+)')
+URL_TEMPLATE_RE = re.compile(rb'"{}/\w*')
+
+# Doc comments opening the generated type sections that delimit the removed ones
+SECTION_MARKERS = {
+    'access_key': b'#[doc = "Access key provides limited access',
+    'account_id': b'#[doc = "NEAR Account Identifier',
+    'account_id_validity': b'#[doc = "`AccountIdValidityRulesVersion`"]',
+    'crypto_hash': b'#[doc = "`CryptoHash`"]',
+    'current_epoch': b'#[doc = "Describes information about the current epoch validator"]',
+    'error': b'#[doc = r" Error types."]',
+    'near_gas': b'#[doc = "`NearGas`"]',
+    'network_info_view': b'#[doc = "`NetworkInfoView`"]',
+}
+
+# Sections of the generated types module replaced by external crates or hand-written code,
+# each given as (first section to remove, first section to keep)
+REMOVED_SECTIONS = [
+    # AccountId comes from near-account-id
+    ('account_id', 'account_id_validity'),
+    # NearGas and NearToken come from near-gas and near-token
+    ('near_gas', 'network_info_view'),
+    # Inline error module lives in error.rs
+    ('error', 'access_key'),
+    # CryptoHash lives in util.rs
+    ('crypto_hash', 'current_epoch'),
+]
+
+# Package fields written by progenitor, replaced by the workspace ones in both crates
+GENERATED_PACKAGE_FIELDS = b'version = "0.0.0"\nedition = "2021"\nlicense = "SPECIFY A LICENSE BEFORE PUBLISHING"'
+WORKSPACE_PACKAGE_FIELDS = b"""version.workspace = true
+edition.workspace = true
+license.workspace = true
+repository.workspace = true
+description = "{description}"
+"""
+
+# Client-specific dependencies not needed for types crate
+CLIENT_ONLY_DEPS_RE = re.compile(rb'^(?:bytes|futures-core|progenitor-client|serde_urlencoded) = "[^"]+"\n|^reqwest = \{[^}]+\}\n', re.MULTILINE)
 
 def reconstructAllOfOneOf(schema):
     # return
@@ -19,115 +63,85 @@ def reconstructAllOfOneOf(schema):
             # we'll treat it as a oneOf with a single element
             one_of_lists.append([item])
     
-    # Generate all combinations of the elements from all oneOf arrays
-    combinations = list(itertools.product(*one_of_lists))
-    
-    # Create a new oneOf array with allOf entries for each combination
-    new_one_of = []
-    for combo in combinations:
-        combined = {
-            "allOf": list(combo)
-        }
-        new_one_of.append(combined)
-    
-    # Replace the allOf with oneOf in the schema
-    schema.pop("allOf")
-    schema["oneOf"] = new_one_of
-
-def iterate_nested_json_for_loop(json_obj):
-    if isinstance(json_obj, dict):
-        if 'allOf' in json_obj:
-            oneOfs = 0
-            for item in json_obj['allOf']:
-                if 'oneOf' in item:
-                    oneOfs += 1
-            if oneOfs >= 2:
-                reconstructAllOfOneOf(json_obj)
-        for key, value in json_obj.items():
-            iterate_nested_json_for_loop(value)
-    if isinstance(json_obj, list):
-        for item in json_obj:
-            iterate_nested_json_for_loop(item)
-
-filename = 'openapi.json'
-
-f = open(filename, 'r')
-spec = json.load(f)
-if 'anyOf' in spec['components']['schemas']['GlobalContractIdentifierView']:
-    spec['components']['schemas']['GlobalContractIdentifierView']['oneOf'] = spec['components']['schemas']['GlobalContractIdentifierView'].pop('anyOf')
-f.close()
-
-
-if len(sys.argv) == 2 and sys.argv[1] == '--spec-fix':
-    iterate_nested_json_for_loop(spec)
-    print('spec fixed')
+    # Replace the allOf with a oneOf holding an allOf entry for each combination
+    # of the elements from all oneOf arrays
+    del schema["allOf"]
+    schema["oneOf"] = [{"allOf": combo} for combo in map(list, itertools.product(*one_of_lists))]
 
-f = open(filename, 'w')
-json.dump(spec, f, indent=4)
-f.close()
-
-if len(sys.argv) == 2 and sys.argv[1] == '--lib-fix':
-    all_lib_rs_file = open('./near-openapi/src/lib.rs', 'r')
-    lib_rs = all_lib_rs_file.read()
-    all_lib_rs_file.close()
-    
-    types_start = """#[doc = r" Types used as operation parameters and responses."]
-#[allow(clippy::all)]
-pub mod types {"""
-    types_index = lib_rs.find(types_start)
-    client_index = lib_rs.find("""#[derive(Clone, Debug)]
-#[doc = "Client for NEAR Protocol JSON RPC API""")
-    
-    print(types_index, client_index)
-    
-    dependencies = lib_rs[:types_index]
-    types = lib_rs[types_index:client_index]
-    client = lib_rs[client_index:]
+def has_multiple_one_of(all_of):
+    oneOfs = 0
+    for item in all_of:
+        if 'oneOf' in item:
+            oneOfs += 1
+            if oneOfs == 2:
+                return True
+    return False
 
-    types = 'pub use near_account_id::AccountId;\npub use near_gas::NearGas;\npub use near_token::NearToken;\n' + types[len(types_start):-2]
-    types = types.replace('super::NearToken("0".to_string())', 'super::NearToken::from_yoctonear(0)')
-    account_id_start = types.find('#[doc = "NEAR Account Identifier')
-    account_id_validity_start = types.find('#[doc = "`AccountIdValidityRulesVersion`"]')
-    types = types[:account_id_start] + types[account_id_validity_start:]
-    near_gas_start = types.find('#[doc = "`NearGas`"]')
-    network_info_view_start = types.find('#[doc = "`NetworkInfoView`"]') # remove NearGas and NearToken
-    types = types[:near_gas_start] + types[network_info_view_start:]
-
-    # Remove inline error module
-    error_start = types.find('#[doc = r" Error types."]')
-    access_key_start = types.find('#[doc = "Access key provides limited access')
-    types = types[:error_start] + types[access_key_start:]
-
-    # Remove CryptoHash definition
-    crypto_hash_start = types.find('#[doc = "`CryptoHash`"]')
-    current_epoch_start = types.find('#[doc = "Describes information about the current epoch validator"]')
-    types = types[:crypto_hash_start] + types[current_epoch_start:]
+def iterate_nested_json_for_loop(json_obj):
+    # Walk with an explicit stack: deeply nested specs would otherwise
+    # create a Python frame per node and may hit the recursion limit.
+    # Children are pushed in reverse so they are visited in document order like
+    # the recursive walk did: whether a combination still needs reconstructing
+    # depends on which of its siblings were rewritten before it
+    stack = [json_obj]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is dict:
+            all_of = node.get('allOf')
+            if all_of is not None and has_multiple_one_of(all_of):
+                # The new combinations are walked like any other child, so the
+                # ones that still hold several oneOf are reconstructed in turn
+                reconstructAllOfOneOf(node)
+            stack.extend(reversed(node.values()))
+        elif node_type is list:
+            stack.extend(reversed(node))
+
+def write_file(path, content):
+    # Write the file through a raw descriptor, handing the whole payload to a
+    # single writev instead of going through a buffered file object
+    data = memoryview(content)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        while data:
+            data = data[os.writev(fd, [data]):]
+    finally:
+        os.close(fd)
+
+def fix_types_crate(types, cargo_toml):
+    types = types.replace(b'super::NearToken("0".to_string())', b'super::NearToken::from_yoctonear(0)')
+    # Locate all sections to drop, then keep everything in between
+    section_starts = {name: types.find(marker) for name, marker in SECTION_MARKERS.items()}
+    removed = sorted((section_starts[start], section_starts[end]) for start, end in REMOVED_SECTIONS)
+    kept = [b'pub use near_account_id::AccountId;\npub use near_gas::NearGas;\npub use near_token::NearToken;\n']
+    position = 0
+    for start, end in removed:
+        kept.append(types[position:start])
+        position = end
+    kept.append(types[position:])
+    types = b''.join(kept)
 
     # Add thiserror::Error and strum_macros::Display derives for error types
     # Match RpcRequestValidationErrorKind and types ending with Error (but not JsonRpcResponseFor*)
 
     # First find all types that already have Display impl
-    types_with_display = set(re.findall(r'impl ::std::fmt::Display for (\w+)', types))
+    types_with_display = frozenset(DISPLAY_IMPL_RE.findall(types))
 
     def add_error_derives(m):
-        if m.group(4).startswith('JsonRpcResponseFor'):
+        if m.group(4).startswith(b'JsonRpcResponseFor'):
             return m.group(0)
-        derives = m.group(1).rstrip().rstrip(',')  # Remove trailing whitespace and comma
+        derives = m.group(1).rstrip().rstrip(b',')  # Remove trailing whitespace and comma
         type_name = m.group(4)
         # Only add strum_macros::Display if type doesn't already have Display impl
         if type_name in types_with_display:
-            new_derives = f'{derives}, thiserror::Error'
+            new_derives = derives + b', thiserror::Error'
         else:
-            new_derives = f'{derives}, thiserror::Error, strum_macros::Display'
-        return f'#[derive({new_derives})]{m.group(2)}{m.group(3)}pub enum {type_name}'
+            new_derives = derives + b', thiserror::Error, strum_macros::Display'
+        return b'#[derive(%s)]%s%spub enum %s' % (new_derives, m.group(2), m.group(3), type_name)
 
-    types = re.sub(
-        r'#\[derive\(([^)]+)\)\](\n(?:\s*#\[[^\n]+\n)*)(\s*)pub enum (RpcRequestValidationErrorKind|[A-Z][a-zA-Z0-9]*Error)\b',
-        add_error_derives,
-        types
-    )
+    types = ERROR_ENUM_RE.sub(add_error_derives, types)
 
-    types_lib_rs = """//! This crate provides types for the Near OpenAPI specification.
+    types_lib_rs = b"""//! This crate provides types for the Near OpenAPI specification.
 //!
 //! Used in [near-openapi-client](https://docs.rs/near-openapi-client/latest/near_openapi_client/)
 pub mod error;
@@ -135,63 +149,77 @@ mod util;
 pub use util::CryptoHash;
 """ + types
 
-    client_lib_rs = dependencies + client
-    client_lib_rs = 'pub use near_openapi_types as types;\n' + client_lib_rs
-    client_lib_rs = re.sub('"{}/\w*', '"{}/', client_lib_rs)
-    
-    readme_md = open('./README.md', 'r')
-    client_docs = readme_md.readlines()
-    index_of_finish = client_docs.index('### Generate libraries and test:\n')
-    client_docs = ['//!' + line for line in client_docs[:index_of_finish]]
-    client_lib_rs = '\n'.join(client_docs) + client_lib_rs
-
-    if not os.path.isdir('./near-openapi-client/src'):
-        os.makedirs('./near-openapi-client/src')
-    client_lib_rs_file = open('./near-openapi-client/src/lib.rs', 'w')
-    client_lib_rs_file.write(client_lib_rs)
-    client_lib_rs_file.close()
-    
-    if not os.path.isdir('./near-openapi-types/src'):
-        os.makedirs('./near-openapi-types/src')
-    types_lib_rs_file = open('./near-openapi-types/src/lib.rs', 'w')
-    types_lib_rs_file.write(types_lib_rs)
-    types_lib_rs_file.close()
-    
-    all_cargo_toml_file = open('./near-openapi/Cargo.toml', 'r')
-    cargo_toml = all_cargo_toml_file.read()
-    all_cargo_toml_file.close()
-    
-    cargo_toml = re.sub('\[workspace\]', '', cargo_toml)
-    
-    client_cargo_toml = re.sub('near-openapi', 'near-openapi-client', cargo_toml)
-    client_cargo_toml = re.sub('version = "0.0.0"\nedition = "2021"\nlicense = "SPECIFY A LICENSE BEFORE PUBLISHING"', """version.workspace = true
-edition.workspace = true
-license.workspace = true
-repository.workspace = true
-description = "Progenitor-generated client of NEAR JSON RPC API"
-""", client_cargo_toml)
-    client_cargo_toml += 'near-openapi-types.workspace = true\n'
-    types_cargo_toml = re.sub('near-openapi', 'near-openapi-types', cargo_toml)
-    types_cargo_toml = re.sub('version = "0.0.0"\nedition = "2021"\nlicense = "SPECIFY A LICENSE BEFORE PUBLISHING"', """version.workspace = true
-edition.workspace = true
-license.workspace = true
-repository.workspace = true
-description = "Types for progenitor-generated client of NEAR JSON RPC API"
-""", types_cargo_toml)
+    types_cargo_toml = cargo_toml.replace(b'near-openapi', b'near-openapi-types').replace(b'{description}', b'Types for progenitor-generated client of NEAR JSON RPC API')
     # Remove client-specific dependencies not needed for types crate
-    types_cargo_toml = re.sub(r'bytes = "[^"]+"\n', '', types_cargo_toml)
-    types_cargo_toml = re.sub(r'futures-core = "[^"]+"\n', '', types_cargo_toml)
-    types_cargo_toml = re.sub(r'progenitor-client = "[^"]+"\n', '', types_cargo_toml)
-    types_cargo_toml = re.sub(r'reqwest = \{[^}]+\}\n', '', types_cargo_toml)
-    types_cargo_toml = re.sub(r'serde_urlencoded = "[^"]+"\n', '', types_cargo_toml)
-    types_cargo_toml += 'near-account-id = { version = "2.0", features = ["serde"] }\nnear-gas = { version = "0.3.2", features = ["serde"] }\nnear-token = { version = "0.3.1", features = ["serde"] }\nthiserror = "2.0.17"\nstrum_macros = "0.27.2"\nbs58 = "0.5.1"\n'
+    types_cargo_toml = CLIENT_ONLY_DEPS_RE.sub(b'', types_cargo_toml)
+    types_cargo_toml += b'near-account-id = { version = "2.0", features = ["serde"] }\nnear-gas = { version = "0.3.2", features = ["serde"] }\nnear-token = { version = "0.3.1", features = ["serde"] }\nthiserror = "2.0.17"\nstrum_macros = "0.27.2"\nbs58 = "0.5.1"\n'
+
+    os.makedirs('./near-openapi-types/src', exist_ok=True)
+    write_file('./near-openapi-types/src/lib.rs', types_lib_rs)
+    write_file('./near-openapi-types/Cargo.toml', types_cargo_toml)
+
+def fix_client_crate(dependencies, client, cargo_toml):
+    # Operation paths only occur in the client impl
+    client = URL_TEMPLATE_RE.sub(b'"{}/', client)
+
+    readme = Path('./README.md').read_bytes()
+    readme = readme[:readme.index(b'\n### Generate libraries and test:\n') + 1]
+    # Turn every README line into a `//!` line followed by an empty line
+    client_docs = b'//!' + readme[:-1].replace(b'\n', b'\n\n//!') + b'\n'
+    client_lib_rs = b''.join([
+        client_docs,
+        b'pub use near_openapi_types as types;\n',
+        dependencies,
+        client,
+    ])
+
+    client_cargo_toml = cargo_toml.replace(b'near-openapi', b'near-openapi-client').replace(b'{description}', b'Progenitor-generated client of NEAR JSON RPC API')
+    client_cargo_toml += b'near-openapi-types.workspace = true\n'
+
+    os.makedirs('./near-openapi-client/src', exist_ok=True)
+    write_file('./near-openapi-client/src/lib.rs', client_lib_rs)
+    write_file('./near-openapi-client/Cargo.toml', client_cargo_toml)
+
+spec_path = Path('openapi.json')
+
+spec_bytes = spec_path.read_bytes()
+spec = json.loads(spec_bytes)
+if 'anyOf' in spec['components']['schemas']['GlobalContractIdentifierView']:
+    spec['components']['schemas']['GlobalContractIdentifierView']['oneOf'] = spec['components']['schemas']['GlobalContractIdentifierView'].pop('anyOf')
+
+
+if len(sys.argv) == 2 and sys.argv[1] == '--spec-fix':
+    iterate_nested_json_for_loop(spec)
+    print('spec fixed')
+
+# Always normalize to the committed layout (4-space indent, ASCII escapes),
+# but skip the write when the file is already in that exact form
+normalized_spec = json.dumps(spec, indent=4).encode()
+if normalized_spec != spec_bytes:
+    write_file(spec_path, normalized_spec)
+
+if len(sys.argv) == 2 and sys.argv[1] == '--lib-fix':
+    lib_rs = Path('./near-openapi/src/lib.rs').read_bytes()
     
-    client_cargo_toml_file = open('./near-openapi-client/Cargo.toml', 'w')
-    client_cargo_toml_file.write(client_cargo_toml)
-    client_cargo_toml_file.close()
+    types_start = b"""#[doc = r" Types used as operation parameters and responses."]
+#[allow(clippy::all)]
+pub mod types {"""
+    types_index = lib_rs.find(types_start)
+    client_index = lib_rs.find(b"""#[derive(Clone, Debug)]
+#[doc = "Client for NEAR Protocol JSON RPC API""")
     
-    types_cargo_toml_file = open('./near-openapi-types/Cargo.toml', 'w')
-    types_cargo_toml_file.write(types_cargo_toml)
-    types_cargo_toml_file.close()
+    print(types_index, client_index)
     
+    dependencies = lib_rs[:types_index]
+    # Body of the types module, without its header and closing brace
+    types = lib_rs[types_index + len(types_start):client_index - 2]
+    client = lib_rs[client_index:]
+
+    cargo_toml = Path('./near-openapi/Cargo.toml').read_bytes()
+    # Both crate manifests share everything except the package name and description
+    cargo_toml = cargo_toml.replace(b'[workspace]', b'').replace(GENERATED_PACKAGE_FIELDS, WORKSPACE_PACKAGE_FIELDS)
+
+    fix_types_crate(types, cargo_toml)
+    fix_client_crate(dependencies, client, cargo_toml)
+
     print('lib fixed')